@@ -0,0 +1,96 @@
+"""
+Peak RSS per image job (segmentation via remove.bg + compositing).
+
+Each case runs in a fresh process with a mocked remove.bg response, so the
+figure is the job's own RSS peak above its starting RSS. Point --tree at
+another checkout to compare revisions:
+
+    git worktree add /tmp/before <commit>
+    python bench_memory.py --tree /tmp/before
+    python bench_memory.py
+"""
+import os
+import io
+import sys
+import argparse
+import subprocess
+import tempfile
+
+CASES = ['#FF0000', 'gradient', 'transparent']
+
+
+def status_kb(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    raise OSError(f"{field} not in /proc/self/status")
+
+
+def make_inputs(directory, width, height):
+    from PIL import Image
+    photo = Image.effect_noise((width, height), 64).convert('RGB')
+    photo.save(os.path.join(directory, 'photo.jpg'), format='JPEG', quality=85)
+    cutout = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+    cutout.paste(photo.crop((width // 4, height // 4, 3 * width // 4, 3 * height // 4)),
+                 (width // 4, height // 4))
+    cutout.save(os.path.join(directory, 'cutout.png'), format='PNG')
+
+
+def run_child(tree, inputs, color):
+    """Run one job in this (fresh) process and print its peak RSS in MB"""
+    import logging
+    import requests
+
+    with open(os.path.join(inputs, 'photo.jpg'), 'rb') as f:
+        photo = f.read()
+    with open(os.path.join(inputs, 'cutout.png'), 'rb') as f:
+        cutout = f.read()
+
+    class Response:
+        status_code = 200
+        content = cutout
+        text = ''
+
+    requests.post = lambda *args, **kwargs: Response()
+    os.environ['REMOVE_BG_API_KEY'] = 'bench'
+    os.environ.setdefault('BOT_TOKEN', '123456:BENCH')
+    os.environ['LOCAL_PRELOAD'] = '0'
+    os.environ['RESULT_INDEX_PATH'] = ':memory:'
+    sys.path.insert(0, tree)
+    import main
+    logging.disable(logging.CRITICAL)
+
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')  # Reset VmHWM to the current RSS
+    before = status_kb('VmRSS')
+    transparent = main.remove_background_api(photo)
+    main.apply_background_color(transparent, color)
+    print((status_kb('VmHWM') - before) / 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure peak RSS per image job")
+    parser.add_argument('--tree', default=os.path.dirname(os.path.abspath(__file__)),
+                        help="Checkout whose main.py is measured")
+    parser.add_argument('--width', type=int, default=3000)
+    parser.add_argument('--height', type=int, default=2000)
+    parser.add_argument('--child', nargs=2, metavar=('INPUTS', 'COLOR'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return run_child(os.path.abspath(args.tree), *args.child)
+
+    with tempfile.TemporaryDirectory() as inputs:
+        make_inputs(inputs, args.width, args.height)
+        print(f"{args.tree} ({args.width}x{args.height})")
+        for color in CASES:
+            out = subprocess.run(
+                [sys.executable, __file__, '--tree', args.tree, '--child', inputs, color],
+                capture_output=True, text=True, check=True,
+            ).stdout
+            print(f"  {color:12} peak RSS {float(out.split()[-1]):7.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,451 @@
+"""
+End-to-end load generator for the Background Remover Bot.
+
+Starts a local stand-in for the Telegram Bot API and for remove.bg, points
+the bot in main.py at them (TELEGRAM_API_URL / REMOVE_BG_API_URL) and drives
+simulated users that send photos and tap color buttons.
+
+Usage:
+    python loadtest.py --mode both --users 1,5,20 --jobs-per-user 3
+    python loadtest.py --mode webhook --users 10 --removebg-latency 300
+
+Reports end-to-end latency distributions, throughput and error rate per
+user level; the highest throughput across levels is the observed ceiling.
+"""
+import os
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import itertools
+import threading
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import requests
+from PIL import Image
+
+TOKEN = "123456:LOADTEST"
+STEP_TIMEOUT = 60  # Seconds a simulated user waits for each bot reply
+
+
+def make_photo(width, height):
+    """Build a JPEG 'photo' and the matching transparent PNG remove.bg returns"""
+    photo = Image.effect_noise((width, height), 64).convert('RGB')
+    jpeg = io.BytesIO()
+    photo.save(jpeg, format='JPEG', quality=85)
+
+    cutout = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+    cutout.paste(photo.crop((width // 4, height // 4, 3 * width // 4, 3 * height // 4)),
+                 (width // 4, height // 4))
+    png = io.BytesIO()
+    cutout.save(png, format='PNG')
+    return jpeg.getvalue(), png.getvalue()
+
+
+# ==================== FAKE TELEGRAM + REMOVE.BG ====================
+class FakeServices:
+    """State shared by the fake Bot API and remove.bg endpoints"""
+
+    def __init__(self, photo_bytes, cutout_png, removebg_latency):
+        self.photo_bytes = photo_bytes
+        self.cutout_png = cutout_png
+        self.removebg_latency = removebg_latency
+
+        self.lock = threading.Condition()
+        self.updates = []  # Pending updates for getUpdates
+        self.polling_started = threading.Event()  # Set on the first getUpdates call
+        self.webhook_url = None
+        self.webhook_secret = None
+        self.webhook_pool = ThreadPoolExecutor(max_workers=40)  # Telegram's default max_connections
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.file_ids = itertools.count(1)
+        self.waiters = {}  # chat_id -> ChatWaiter
+        self.callback_chats = {}  # callback_query_id -> chat_id
+        self.uploads = 0  # sendDocument calls carrying new bytes
+        self.reused = 0  # sendDocument calls reusing a file_id
+
+    # ---- update delivery ----
+    def push_update(self, update):
+        update['update_id'] = next(self.update_ids)
+        if self.webhook_url:
+            self.webhook_pool.submit(self._deliver_webhook, update)
+        else:
+            with self.lock:
+                self.updates.append(update)
+                self.lock.notify_all()
+
+    def _deliver_webhook(self, update):
+        try:
+            headers = {'X-Telegram-Bot-Api-Secret-Token': self.webhook_secret or ''}
+            requests.post(self.webhook_url, json=update, headers=headers, timeout=STEP_TIMEOUT)
+        except requests.RequestException:
+            pass  # Surfaces as a timeout on the simulated user's side
+
+    def get_updates(self, offset, timeout):
+        self.polling_started.set()
+        deadline = time.time() + timeout
+        with self.lock:
+            self.updates = [u for u in self.updates if u['update_id'] >= offset]
+            while not self.updates and time.time() < deadline:
+                self.lock.wait(deadline - time.time())
+            batch = self.updates[:100]
+        return batch
+
+    # ---- bot replies ----
+    def message(self, chat_id, **extra):
+        msg = {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': 1, 'is_bot': True, 'first_name': 'LoadTestBot'},
+        }
+        msg.update(extra)
+        return msg
+
+    def notify(self, chat_id, event, payload=None):
+        waiter = self.waiters.get(chat_id)
+        if waiter:
+            waiter.put(event, payload)
+
+    def handle_api(self, method, params):
+        chat_id = int(params['chat_id']) if 'chat_id' in params else None
+
+        if method == 'getUpdates':
+            return self.get_updates(int(params.get('offset', 0)), float(params.get('timeout', 0)))
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'LoadTestBot', 'username': 'loadtest_bot'}
+        if method == 'setWebhook':
+            self.webhook_url = params.get('url')
+            self.webhook_secret = params.get('secret_token')
+            return True
+        if method == 'deleteWebhook':
+            self.webhook_url = None
+            return True
+        if method == 'getFile':
+            return {
+                'file_id': params['file_id'],
+                'file_unique_id': params['file_id'],
+                'file_size': len(self.photo_bytes),
+                'file_path': f"photos/{params['file_id']}.jpg",
+            }
+        if method == 'sendMessage':
+            markup = params.get('reply_markup', '')
+            msg = self.message(chat_id, text=params.get('text', ''))
+            if 'callback_data' in markup and 'color_' in markup:
+                self.notify(chat_id, 'keyboard', msg)
+            return msg
+        if method == 'editMessageText':
+            if params.get('text', '').startswith('❌'):
+                self.notify(chat_id, 'error', params['text'])
+            return self.message(chat_id, text=params.get('text', ''))
+        if method == 'sendDocument':
+            file_id = params.get('document')
+            with self.lock:
+                if file_id:
+                    self.reused += 1
+                else:
+                    self.uploads += 1
+                    file_id = f"DOC{next(self.file_ids)}"
+            msg = self.message(chat_id, document={'file_id': file_id, 'file_unique_id': file_id})
+            self.notify(chat_id, 'document', msg)
+            return msg
+        if method == 'answerCallbackQuery':
+            text = params.get('text', '')
+            if text.startswith('❌'):
+                # Callback answers carry no chat id; map the query id back to its chat
+                self.notify(self.callback_chats.pop(params.get('callback_query_id'), None), 'error', text)
+            return True
+        # sendMessage replies, deleteMessage and anything else just succeed
+        return True
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    services = None  # Set by start_fake_server
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _route(self):
+        url = urlparse(self.path)
+        body = self._read_body()
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        parts = url.path.strip('/').split('/')
+
+        if url.path == '/v1.0/removebg':
+            time.sleep(self.services.removebg_latency)
+            return self._send(200, self.services.cutout_png, 'image/png')
+
+        if parts[0] == 'file' and len(parts) > 2:
+            # Trailing bytes after the JPEG end marker give each file its own content hash
+            return self._send(200, self.services.photo_bytes + parts[-1].encode(), 'image/jpeg')
+
+        if parts[0].startswith('bot') and len(parts) == 2:
+            if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+                params.update({k: v[0] for k, v in parse_qs(body.decode()).items()})
+            result = self.services.handle_api(parts[1], params)
+            return self._send(200, json.dumps({'ok': True, 'result': result}).encode())
+
+        self._send(404, b'{"ok": false, "error_code": 404, "description": "Not Found"}')
+
+    do_GET = _route
+    do_POST = _route
+
+
+def start_fake_server(services):
+    FakeHandler.services = services
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# ==================== SIMULATED USERS ====================
+class ChatWaiter:
+    """Collects bot replies for one simulated chat"""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.events = []
+
+    def put(self, event, payload):
+        with self.cond:
+            self.events.append((event, payload))
+            self.cond.notify_all()
+
+    def wait_for(self, wanted, timeout=STEP_TIMEOUT):
+        deadline = time.time() + timeout
+        with self.cond:
+            while True:
+                for i, (event, payload) in enumerate(self.events):
+                    if event in (wanted, 'error'):
+                        del self.events[i]
+                        return event, payload
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return 'timeout', None
+                self.cond.wait(remaining)
+
+
+def run_user(services, user_id, jobs, colors, distinct_photos, results):
+    waiter = services.waiters.setdefault(user_id, ChatWaiter())
+    sender = {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}"}
+    chat = {'id': user_id, 'type': 'private'}
+
+    for job in range(jobs):
+        if distinct_photos:
+            file_id = f"PHOTO{random.randrange(distinct_photos)}"
+        else:
+            file_id = f"PHOTO{user_id}_{job}"
+        started = time.time()
+        services.push_update({'message': {
+            'message_id': next(services.message_ids),
+            'date': int(started),
+            'from': sender,
+            'chat': chat,
+            'photo': [{'file_id': file_id, 'file_unique_id': file_id, 'width': 800, 'height': 600}],
+        }})
+
+        event, keyboard_msg = waiter.wait_for('keyboard')
+        if event != 'keyboard':
+            results.append({'ok': False, 'error': event})
+            continue
+        keyboard_at = time.time()
+
+        callback_id = f"CB{user_id}_{job}"
+        services.callback_chats[callback_id] = user_id
+        services.push_update({'callback_query': {
+            'id': callback_id,
+            'from': sender,
+            'chat_instance': str(user_id),
+            'message': keyboard_msg,
+            'data': f"color_{random.choice(colors)}",
+        }})
+
+        event, _ = waiter.wait_for('document')
+        done = time.time()
+        services.callback_chats.pop(callback_id, None)
+        if event != 'document':
+            results.append({'ok': False, 'error': event})
+            continue
+        results.append({
+            'ok': True,
+            'prompt': keyboard_at - started,  # photo -> color keyboard
+            'result': done - keyboard_at,  # tap -> document (segment, render, send)
+            'total': done - started,
+        })
+
+
+# ==================== REPORTING ====================
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def report(mode, users, results, elapsed, uploads, reused):
+    ok = [r for r in results if r['ok']]
+    errors = len(results) - len(ok)
+    line = {
+        'mode': mode,
+        'users': users,
+        'jobs': len(results),
+        'errors': errors,
+        'error_rate': errors / len(results) if results else 0.0,
+        'throughput_jobs_per_s': len(ok) / elapsed if elapsed else 0.0,
+        'uploads': uploads,
+        'reused': reused,
+    }
+    for stage in ('prompt', 'result', 'total'):
+        values = [r[stage] for r in ok]
+        line[stage] = {f"p{p}": round(percentile(values, p) * 1000, 1) for p in (50, 90, 99)}
+        line[stage]['max'] = round(max(values) * 1000, 1) if values else float('nan')
+    return line
+
+
+def print_report(lines):
+    print(f"\n{'mode':8} {'users':>5} {'jobs':>5} {'err%':>6} {'jobs/s':>7}  "
+          f"{'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8} {'upload':>6} {'reuse':>6}")
+    for line in lines:
+        total = line['total']
+        print(f"{line['mode']:8} {line['users']:>5} {line['jobs']:>5} "
+              f"{line['error_rate'] * 100:>5.1f}% {line['throughput_jobs_per_s']:>7.2f}  "
+              f"{total['p50']:>8} {total['p90']:>8} {total['p99']:>8} {total['max']:>8} "
+              f"{line['uploads']:>6} {line['reused']:>6}")
+    by_mode = {}
+    for line in lines:
+        best = by_mode.get(line['mode'])
+        if best is None or line['throughput_jobs_per_s'] > best['throughput_jobs_per_s']:
+            by_mode[line['mode']] = line
+    for mode, best in by_mode.items():
+        print(f"⚡ {mode} throughput ceiling: {best['throughput_jobs_per_s']:.2f} jobs/s "
+              f"at {best['users']} users")
+
+
+# ==================== DRIVER ====================
+def run_mode(args):
+    """Run one mode in this process: main.py can only be imported once"""
+    jpeg, png = make_photo(args.width, args.height)
+    services = FakeServices(jpeg, png, args.removebg_latency / 1000)
+    fake = start_fake_server(services)
+    fake_url = f"http://127.0.0.1:{fake.server_address[1]}"
+
+    os.environ['BOT_TOKEN'] = TOKEN
+    os.environ['TELEGRAM_API_URL'] = fake_url
+    os.environ['REMOVE_BG_API_KEY'] = 'loadtest'
+    os.environ['REMOVE_BG_API_URL'] = f"{fake_url}/v1.0/removebg"
+    os.environ['RESULT_INDEX_PATH'] = os.path.join(tempfile.mkdtemp(), 'result_index.db')
+    os.environ['LOCAL_PRELOAD'] = '0'  # The fake remove.bg never falls back to rembg
+
+    if args.mode == 'webhook':
+        from werkzeug.serving import make_server
+        import main
+        app_server = make_server('127.0.0.1', 0, main.app, threaded=True)
+        threading.Thread(target=app_server.serve_forever, daemon=True).start()
+        main.WEBHOOK_URL = f"http://127.0.0.1:{app_server.server_port}/webhook"
+        main.start_bot()
+    else:
+        import main
+        threading.Thread(target=main.start_bot, daemon=True).start()
+        # start_bot sleeps after removing the webhook; start once it really polls
+        if not services.polling_started.wait(STEP_TIMEOUT):
+            sys.exit("Bot never called getUpdates")
+
+    if not args.verbose:
+        main.logger.setLevel('WARNING')
+
+    colors = [name for name in main.COLOR_OPTIONS]
+    lines = []
+    user_ids = itertools.count(1000)
+    for users in args.users:
+        results = []
+        threads = [
+            threading.Thread(target=run_user,
+                             args=(services, next(user_ids), args.jobs_per_user, colors,
+                                   args.distinct_photos, results))
+            for _ in range(users)
+        ]
+        uploads, reused = services.uploads, services.reused
+        started = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        lines.append(report(args.mode, users, results, time.time() - started,
+                            services.uploads - uploads, services.reused - reused))
+
+    if args.mode == 'polling':
+        main.bot.stop_polling()
+    return lines
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test the bot against local fake services")
+    parser.add_argument('--mode', choices=['polling', 'webhook', 'both'], default='both')
+    parser.add_argument('--users', default='1,5,20',
+                        type=lambda s: [int(n) for n in s.split(',')],
+                        help="Comma-separated concurrent user levels")
+    parser.add_argument('--jobs-per-user', type=int, default=3)
+    parser.add_argument('--distinct-photos', type=int, default=0,
+                        help="Cycle through N source images (0 = every photo unique)")
+    parser.add_argument('--removebg-latency', type=float, default=200, help="Fake remove.bg delay (ms)")
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=960)
+    parser.add_argument('--json', action='store_true', help="Print raw JSON result lines")
+    parser.add_argument('--verbose', action='store_true', help="Keep the bot's INFO logging")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.mode == 'both':
+        # Each mode gets a fresh process so main.py's bot is configured once
+        lines = []
+        child_argv = [
+            '--users', ','.join(str(n) for n in args.users),
+            '--jobs-per-user', str(args.jobs_per_user),
+            '--removebg-latency', str(args.removebg_latency),
+            '--width', str(args.width),
+            '--height', str(args.height),
+            '--distinct-photos', str(args.distinct_photos),
+            '--json',
+        ]
+        for mode in ('polling', 'webhook'):
+            out = subprocess.run(
+                [sys.executable, __file__, '--mode', mode] + child_argv,
+                capture_output=True, text=True, check=True,
+            ).stdout
+            lines += [json.loads(l) for l in out.splitlines() if l.startswith('{')]
+    else:
+        lines = run_mode(args)
+
+    if args.json:
+        for line in lines:
+            print(json.dumps(line))
+    else:
+        print_report(lines)
+
+
+if __name__ == '__main__':
+    main()
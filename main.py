@@ -2,13 +2,15 @@ import os
 import io
 import logging
 from PIL import Image
-from flask import Flask, request
+from flask import Flask, request, abort
 import telebot
-from telebot import types
+from telebot import types, apihelper
 import requests
 import threading
+import hashlib
+import hmac
+import sqlite3
 import time
-import base64
 from io import BytesIO
 
 # Setup logging
@@ -24,16 +26,40 @@ app = Flask(__name__)
 # Bot token
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
 REMOVE_BG_API_KEY = os.environ.get('REMOVE_BG_API_KEY')  # Your API key from remove.bg
+PROFILE_MEMORY = os.environ.get('PROFILE_MEMORY') == '1'  # Log peak RSS per job (serialises jobs)
+
+# Optional endpoint overrides (local Bot API server, load-test stand-ins)
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL')
+REMOVE_BG_API_URL = os.environ.get('REMOVE_BG_API_URL', "https://api.remove.bg/v1.0/removebg")
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')  # Use webhook instead of polling when set
+# Telegram echoes this in X-Telegram-Bot-Api-Secret-Token; derived from the token
+# by default so the web and worker processes agree without extra config
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET') or hashlib.sha256(
+    f"{BOT_TOKEN}:webhook".encode()).hexdigest()
+
+# Uploaded result reuse (Telegram file_id per source image + background)
+RESULT_INDEX_PATH = os.environ.get('RESULT_INDEX_PATH', 'result_index.db')
+RESULT_INDEX_SIZE = int(os.environ.get('RESULT_INDEX_SIZE', 5000))
+
+# Local rembg fallback: models best quality first, and per-job latency target (seconds)
+LOCAL_MODELS = os.environ.get('LOCAL_MODELS', 'isnet-general-use:1024,u2net:800,u2netp:512')
+LOCAL_LATENCY_TARGET = float(os.environ.get('LOCAL_LATENCY_TARGET', 10))
+LOCAL_PRELOAD = os.environ.get('LOCAL_PRELOAD') == '1'  # Opt-in: load all models when the bot starts
 
 if not BOT_TOKEN:
     logger.error("❌ BOT_TOKEN not found!")
     BOT_TOKEN = "YOUR_BOT_TOKEN_HERE"
 
+if TELEGRAM_API_URL:
+    apihelper.API_URL = TELEGRAM_API_URL.rstrip('/') + "/bot{0}/{1}"
+    apihelper.FILE_URL = TELEGRAM_API_URL.rstrip('/') + "/file/bot{0}/{1}"
+    logger.info(f"🔧 Using Telegram API at {TELEGRAM_API_URL}")
+
 bot = telebot.TeleBot(BOT_TOKEN)
 
 # Store user data and preferences
 user_stats = {}
-user_pending_images = {}  # Store temp image data for color selection
+user_pending_images = {}  # Store source hash, raw bytes and (once segmented) ImageHandle per user
 
 # Color options with emoji and hex codes
 COLOR_OPTIONS = {
@@ -58,6 +84,377 @@ COLOR_OPTIONS = {
     "✨ Transparent": "transparent"
 }
 
+# ==================== IMAGE HANDLE ====================
+class ImageHandle:
+    """Decoded image passed between pipeline stages.
+
+    Pixels are decoded at most once and PNG encoding happens at most once,
+    so download, segmentation and compositing share a single RGBA buffer.
+    """
+
+    __slots__ = ('image', '_png', 'source', 'full_quality')
+
+    def __init__(self, image, source=None, full_quality=True):
+        self.image = image if image.mode == 'RGBA' else image.convert('RGBA')
+        self._png = None
+        self.source = source  # e.g. 'remove.bg' or 'u2netp@512'
+        self.full_quality = full_quality  # False when segmented degraded under load
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Decode encoded image bytes (PNG/JPEG) once into RGBA pixels.
+
+        An RGBA PNG (remove.bg's output) keeps its original bytes, so sending
+        it unchanged never re-encodes.
+        """
+        image = Image.open(BytesIO(data))
+        handle = cls(image)
+        if image.format == 'PNG' and image.mode == 'RGBA':
+            handle._png = data
+        return handle
+
+    @property
+    def size(self):
+        return self.image.size
+
+    def to_png(self):
+        """Encode to PNG once and reuse the bytes afterwards"""
+        if self._png is None:
+            output = BytesIO()
+            self.image.save(output, format='PNG')
+            self._png = output.getvalue()
+        return self._png
+
+_profile_lock = threading.Lock()
+
+def _proc_status_kb(field):
+    """Read a Vm* field (in kB) from /proc/self/status"""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    raise OSError(f"{field} not in /proc/self/status")
+
+def measure_peak_memory(func, *args, **kwargs):
+    """Run func and return (result, peak process RSS growth in bytes or None).
+
+    The kernel's RSS high-water mark is reset first, so the figure is this
+    job's own peak above its starting RSS (Pillow buffers included). That
+    needs Linux /proc; elsewhere the peak is None (unavailable). Profiled
+    jobs run one at a time so concurrent jobs don't mix.
+    """
+    with _profile_lock:
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')  # Reset VmHWM to the current RSS
+            before = _proc_status_kb('VmRSS')
+        except OSError:
+            return func(*args, **kwargs), None
+        result = func(*args, **kwargs)
+        after = _proc_status_kb('VmHWM')
+    return result, max(0, after - before) * 1024
+
+def format_peak(peak):
+    return "unavailable (needs /proc)" if peak is None else f"{peak / 1048576:.1f} MB"
+
+# ==================== RESULT INDEX ====================
+class ResultIndex:
+    """Bounded, persistent LRU map from rendered results to Telegram file_ids.
+
+    Keys combine the source content hash, background choice and output
+    settings, so a repeat request can be answered without render or upload.
+    Backed by sqlite so the web and worker processes share one index and
+    every change is a single-row write.
+    """
+
+    OUTPUT_SETTINGS = "png"  # Bump when output encoding changes
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        try:
+            self._db = self._connect(path)
+        except sqlite3.Error as e:
+            logger.error(f"Result index open error, using memory only: {e}")
+            self._db = self._connect(':memory:')
+
+    @staticmethod
+    def _connect(path):
+        db = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS results "
+            "(key TEXT PRIMARY KEY, file_id TEXT NOT NULL, used REAL NOT NULL)"
+        )
+        db.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+        return db
+
+    @classmethod
+    def make_key(cls, source_hash, color_choice):
+        return f"{source_hash}:{color_choice}:{cls.OUTPUT_SETTINGS}"
+
+    def get(self, key):
+        try:
+            with self._lock:
+                row = self._db.execute("SELECT file_id FROM results WHERE key = ?", (key,)).fetchone()
+                if row:
+                    self._db.execute("UPDATE results SET used = ? WHERE key = ?", (time.time(), key))
+            return row[0] if row else None
+        except sqlite3.Error as e:
+            logger.error(f"Result index read error: {e}")
+            return None
+
+    def put(self, key, file_id):
+        try:
+            with self._lock:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO results (key, file_id, used) VALUES (?, ?, ?)",
+                    (key, file_id, time.time())
+                )
+                # Evict least recently used rows beyond the bound
+                self._db.execute(
+                    "DELETE FROM results WHERE key IN "
+                    "(SELECT key FROM results ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)
+                )
+        except sqlite3.Error as e:
+            logger.error(f"Result index write error: {e}")
+
+    def discard(self, key):
+        try:
+            with self._lock:
+                self._db.execute("DELETE FROM results WHERE key = ?", (key,))
+        except sqlite3.Error as e:
+            logger.error(f"Result index write error: {e}")
+
+    def __len__(self):
+        try:
+            with self._lock:
+                return self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        except sqlite3.Error:
+            return 0
+
+    @staticmethod
+    def is_stale_file_id_error(error):
+        """True when Telegram rejected a file_id itself, not the request"""
+        description = (error.description or '').lower()
+        return error.error_code == 400 and (
+            'wrong file identifier' in description
+            or 'wrong remote file identifier' in description
+            or 'file reference' in description
+            or 'file_reference' in description
+        )
+
+result_index = ResultIndex(RESULT_INDEX_PATH, RESULT_INDEX_SIZE)
+
+# ==================== LOCAL SEGMENTATION ENGINE ====================
+class LocalSegmentationEngine:
+    """Pick a rembg model and input resolution per job to meet a latency target.
+
+    rembg resizes every input to the model's own size, so a job costs a fixed
+    per-model inference time plus a per-megapixel term for resizing, mask
+    upscaling and cutout. Under load the engine first steps down to faster
+    models at full resolution, and only then shrinks the input for the
+    fastest model. Quality comes back once the queue drains.
+    """
+
+    # Starting guesses for inference seconds per job, refined from observed jobs
+    DEFAULT_INFERENCE_COSTS = {
+        'isnet-general-use': 2.5,
+        'u2net': 0.8,
+        'u2netp': 0.25
+    }
+    PIXEL_COST = 0.3  # Seconds per output megapixel outside inference, all models
+    RESOLUTION_STEPS = (0.75, 0.5)  # Fallback input sizes for the fastest model
+    SMOOTHING = 0.3
+
+    def __init__(self, tiers, latency_target):
+        self.tiers = tiers  # [(model_name, max_size)] best quality first
+        self.latency_target = latency_target
+        self._sessions = {}
+        self._failed = set()
+        self._loading = set()
+        self._preload_started = False
+        self._costs = {model: self.DEFAULT_INFERENCE_COSTS.get(model, 1.0) for model, _ in tiers}
+        self._in_flight = 0
+        self._jobs_by_model = {model: 0 for model, _ in tiers}
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    @classmethod
+    def from_spec(cls, spec, latency_target):
+        """Build from 'model:max_size,model:max_size' (e.g. LOCAL_MODELS)"""
+        tiers = []
+        for item in spec.split(','):
+            model, _, max_size = item.strip().partition(':')
+            tiers.append((model, int(max_size or 800)))
+        return cls(tiers, latency_target)
+
+    def predict(self, model, size, queue_depth):
+        megapixels = size[0] * size[1] / 1_000_000
+        return (self._costs[model] + self.PIXEL_COST * megapixels) * (queue_depth + 1)
+
+    def _tiers(self):
+        return [t for t in self.tiers if t[0] not in self._failed] or self.tiers
+
+    def top_choice(self, size):
+        """The full-quality (model, max_size) for an input of this size"""
+        model, max_size = self._tiers()[0]
+        return model, min(max(size), max_size)
+
+    def choose(self, size, queue_depth):
+        """Return (model, max_size, predicted_seconds) for an input of this size.
+
+        Every working tier is considered. If the best fit is not loaded yet it
+        is loaded in the background, and this job uses the best loaded option
+        that also fits; it only waits on the load when none does.
+        """
+        tiers = self._tiers()
+        longest = max(size)
+        fastest_model, fastest_size = tiers[-1]
+        ladder = [(model, max_size) for model, max_size in tiers]
+        ladder += [(fastest_model, int(fastest_size * step)) for step in self.RESOLUTION_STEPS]
+        
+        candidates = []
+        for model, max_size in ladder:
+            target_size = min(longest, max_size)
+            scale = target_size / longest
+            scaled = (size[0] * scale, size[1] * scale)
+            candidates.append((model, target_size, self.predict(model, scaled, queue_depth)))
+        
+        fitting = [c for c in candidates if c[2] <= self.latency_target]
+        # Nothing fits: take the fastest option we have
+        best = fitting[0] if fitting else min(candidates, key=lambda c: c[2])
+        if best[0] not in self._sessions:
+            self._load_async(best[0])
+            loaded = [c for c in fitting if c[0] in self._sessions]
+            if loaded:
+                return loaded[0]
+        return best
+
+    def _session(self, model):
+        session = self._sessions.get(model)
+        if session is None:
+            with self._load_lock:
+                session = self._sessions.get(model)
+                if session is None:
+                    from rembg import new_session
+                    logger.info(f"🧠 Loading rembg model {model}")
+                    try:
+                        session = new_session(model)
+                    except Exception:
+                        self._failed.add(model)
+                        raise
+                    self._sessions[model] = session
+        return session
+
+    def _load_async(self, model):
+        """Load a model in the background unless that is already under way"""
+        with self._lock:
+            if model in self._loading or model in self._sessions:
+                return
+            self._loading.add(model)
+        
+        def load():
+            try:
+                self._session(model)
+            except Exception as e:
+                logger.error(f"Failed to load rembg model {model}: {e}")
+            finally:
+                with self._lock:
+                    self._loading.discard(model)
+        
+        threading.Thread(target=load, daemon=True).start()
+
+    def start_preload(self):
+        """Start preload() once in a background thread if rembg is installed"""
+        with self._lock:
+            if self._preload_started:
+                return
+            self._preload_started = True
+        try:
+            # Import here, not in the thread: a first rembg import from a thread
+            # started mid-import hangs the interpreter at exit
+            import rembg  # noqa: F401
+        except ImportError:
+            logger.warning("rembg not available, local fallback disabled")
+            return
+        threading.Thread(target=self.preload, daemon=True).start()
+
+    def preload(self):
+        """Load and calibrate every configured model up front (background thread)"""
+        from rembg import remove
+        for model, _ in self.tiers:
+            try:
+                session = self._session(model)
+                
+                # Warm up, then time one inference so costs start from this box
+                sample = Image.effect_noise((320, 320), 64).convert('RGB')
+                remove(sample, session=session)
+                started = time.time()
+                remove(sample, session=session)
+                with self._lock:
+                    self._costs[model] = max(time.time() - started - self.PIXEL_COST * 0.1, 0.01)
+            except Exception as e:
+                logger.error(f"Failed to load rembg model {model}: {e}")
+        logger.info(f"🧠 Local models ready: {', '.join(self._sessions) or 'none'} (inference {self._costs})")
+
+    def remove(self, input_image, backlog=0):
+        """Segment a PIL image and return an ImageHandle.
+
+        backlog is the number of updates still waiting for a worker; they
+        count towards queue depth so a deep queue drains faster.
+        """
+        from rembg import remove
+        with self._lock:
+            running = self._in_flight
+            queue_depth = running + backlog
+            self._in_flight += 1
+        try:
+            full_choice = self.top_choice(input_image.size)
+            model, max_size, predicted = self.choose(input_image.size, queue_depth)
+            if max(input_image.size) > max_size:
+                ratio = max_size / max(input_image.size)
+                new_size = (int(input_image.width * ratio), int(input_image.height * ratio))
+                input_image = input_image.resize(new_size, Image.Resampling.LANCZOS)
+            
+            session = self._session(model)
+            started = time.time()
+            output_image = remove(input_image, session=session)
+            elapsed = time.time() - started
+            
+            # Normalise by the jobs sharing the CPU, then learn the fixed inference part
+            megapixels = input_image.width * input_image.height / 1_000_000
+            inference = max(elapsed / (running + 1) - self.PIXEL_COST * megapixels, 0.01)
+            with self._lock:
+                self._costs[model] += self.SMOOTHING * (inference - self._costs[model])
+                self._jobs_by_model[model] += 1
+            
+            logger.info(
+                f"🧠 Local model {model} @ {max_size}px (queue {queue_depth}): "
+                f"{elapsed:.2f}s, predicted {predicted:.2f}s, target {self.latency_target:.1f}s"
+            )
+            # Keep rembg's decoded output; it is encoded only when sent
+            return ImageHandle(output_image, source=f"{model}@{max_size}",
+                               full_quality=(model, max_size) == full_choice)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def snapshot(self):
+        """Metrics for /health"""
+        with self._lock:
+            return {
+                'latency_target': self.latency_target,
+                'in_flight': self._in_flight,
+                'loaded_models': list(self._sessions),
+                'jobs_by_model': dict(self._jobs_by_model),
+                'inference_seconds': {m: round(c, 3) for m, c in self._costs.items()}
+            }
+
+local_engine = LocalSegmentationEngine.from_spec(LOCAL_MODELS, LOCAL_LATENCY_TARGET)
+
 # ==================== BACKGROUND REMOVAL FUNCTIONS ====================
 def remove_background_api(image_bytes):
     """Use remove.bg API for high quality removal"""
@@ -65,30 +462,29 @@ def remove_background_api(image_bytes):
         if not REMOVE_BG_API_KEY:
             logger.error("REMOVE_BG_API_KEY not set!")
             return None
-            
-        # Convert image to base64
-        image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-        
-        # Use remove.bg API
-        api_url = "https://api.remove.bg/v1.0/removebg"
         
         headers = {
-            'X-Api-Key': REMOVE_BG_API_KEY,
-            'Content-Type': 'application/json'
+            'X-Api-Key': REMOVE_BG_API_KEY
         }
         
         data = {
-            'image_file_b64': image_base64,
             'size': 'auto',
             'format': 'png',
             'type': 'auto'
         }
         
-        response = requests.post(api_url, json=data, headers=headers, timeout=30)
+        # Upload raw bytes as multipart instead of a base64 JSON copy
+        files = {
+            'image_file': ('image', image_bytes)
+        }
+        
+        response = requests.post(REMOVE_BG_API_URL, data=data, files=files, headers=headers, timeout=30)
         
         if response.status_code == 200:
             logger.info("✅ Background removed via API successfully")
-            return response.content
+            handle = ImageHandle.from_bytes(response.content)
+            handle.source = 'remove.bg'
+            return handle
         else:
             logger.error(f"API Error: {response.status_code} - {response.text}")
             return None
@@ -97,36 +493,23 @@ def remove_background_api(image_bytes):
         logger.error(f"API call error: {e}")
         return None
 
-def apply_background_color(transparent_image_bytes, color_choice):
+def apply_background_color(transparent_image, color_choice):
     """Apply selected background color to transparent image"""
     try:
-        # Open transparent image
-        transparent_img = Image.open(BytesIO(transparent_image_bytes)).convert('RGBA')
-        
         if color_choice == "transparent":
             # Return as is for transparent
-            output = BytesIO()
-            transparent_img.save(output, format='PNG')
-            return output.getvalue()
+            return transparent_image.to_png()
         
-        elif color_choice == "gradient":
-            # Create gradient background
-            width, height = transparent_img.size
-            gradient = Image.new('RGBA', (width, height))
-            
-            # Create gradient from left to right
-            for x in range(width):
-                # Color transition
-                r = int((x / width) * 255)
-                g = int(((width - x) / width) * 255)
-                b = 128
-                color = (r, g, b, 255)
-                
-                for y in range(height):
-                    gradient.putpixel((x, y), color)
-            
-            # Composite image over gradient
-            result = Image.alpha_composite(gradient, transparent_img)
+        width, height = transparent_image.size
+        
+        if color_choice == "gradient":
+            # Create gradient from left to right: one row, stretched vertically
+            row = Image.new('RGBA', (width, 1))
+            row.putdata([
+                (int((x / width) * 255), int(((width - x) / width) * 255), 128, 255)
+                for x in range(width)
+            ])
+            background = row.resize((width, height), Image.Resampling.NEAREST)
             
         else:
             # Solid color background
@@ -135,41 +518,35 @@ def apply_background_color(transparent_image_bytes, color_choice):
             color_rgba = color_rgb + (255,)  # Add alpha channel
             
             # Create colored background
-            background = Image.new('RGBA', transparent_img.size, color_rgba)
-            
-            # Composite image over colored background
-            result = Image.alpha_composite(background, transparent_img)
+            background = Image.new('RGBA', (width, height), color_rgba)
+        
+        # Composite image over background in place
+        background.alpha_composite(transparent_image.image)
         
         # Save to bytes
-        output = BytesIO()
-        result.save(output, format='PNG')
-        return output.getvalue()
+        return ImageHandle(background).to_png()
         
     except Exception as e:
         logger.error(f"Color apply error: {e}")
-        return transparent_image_bytes  # Return original if error
+        return transparent_image.to_png()  # Return original if error
+
+def render_result(transparent_image, color_choice):
+    """Composite the chosen background, logging peak RSS when profiling"""
+    if PROFILE_MEMORY:
+        final_image, peak = measure_peak_memory(apply_background_color, transparent_image, color_choice)
+        logger.info(f"📈 Compositing peak RSS: {format_peak(peak)}")
+        return final_image
+    return apply_background_color(transparent_image, color_choice)
 
 def remove_background_local(image_bytes):
     """Local fallback if API fails"""
     try:
         # Try to use rembg if available
         try:
-            from rembg import remove
             input_image = Image.open(BytesIO(image_bytes))
-            
-            # Resize for faster processing
-            max_size = 800
-            if max(input_image.size) > max_size:
-                ratio = max_size / max(input_image.size)
-                new_size = (int(input_image.width * ratio), int(input_image.height * ratio))
-                input_image = input_image.resize(new_size, Image.Resampling.LANCZOS)
-            
-            output_image = remove(input_image)
-            
-            # Save to bytes
-            img_byte_arr = BytesIO()
-            output_image.save(img_byte_arr, format='PNG')
-            return img_byte_arr.getvalue()
+            worker_pool = getattr(bot, 'worker_pool', None)
+            backlog = worker_pool.tasks.qsize() if worker_pool else 0
+            return local_engine.remove(input_image, backlog=backlog)
             
         except ImportError:
             logger.warning("rembg not available")
@@ -342,43 +719,21 @@ def handle_photo(message):
         downloaded_file = bot.download_file(file_info.file_path)
         file_size = len(downloaded_file) / 1024  # KB
         
-        bot.edit_message_text(
-            f"✅ Downloaded ({file_size:.1f} KB)\n🎨 *Removing background...*",
-            message.chat.id,
-            status_msg.message_id,
-            parse_mode='Markdown'
-        )
-        
-        # Remove background using API
-        transparent_bytes = remove_background_api(downloaded_file)
+        # Keep the raw bytes; segmentation runs on the first color choice
+        # that isn't already in the result index
+        user_pending_images[user_id] = {
+            'source_hash': hashlib.sha256(downloaded_file).hexdigest(),
+            'source_bytes': downloaded_file,
+            'image': None,
+            'lock': threading.Lock()  # One segmentation per photo, even on double taps
+        }
+        logger.info(f"📥 Downloaded {file_size:.1f} KB for user {user_id}")
         
-        if not transparent_bytes:
-            # Fallback to local method
-            bot.edit_message_text(
-                "⚡ *Trying alternative method...*",
-                message.chat.id,
-                status_msg.message_id,
-                parse_mode='Markdown'
-            )
-            transparent_bytes = remove_background_local(downloaded_file)
+        # Delete processing message
+        bot.delete_message(message.chat.id, status_msg.message_id)
         
-        if transparent_bytes:
-            # Store transparent image for this user
-            user_pending_images[user_id] = transparent_bytes
-            
-            # Delete processing message
-            bot.delete_message(message.chat.id, status_msg.message_id)
-            
-            # Ask for color choice
-            ask_for_color(message.chat.id, user_id)
-            
-        else:
-            bot.edit_message_text(
-                "❌ *Failed to remove background.*\n\n⚠️ Please try:\n• Different photo\n• Better lighting\n• Clearer subject",
-                message.chat.id,
-                status_msg.message_id,
-                parse_mode='Markdown'
-            )
+        # Ask for color choice
+        ask_for_color(message.chat.id, user_id)
             
     except Exception as e:
         logger.error(f"❌ Error in handle_photo: {e}")
@@ -388,6 +743,47 @@ def handle_photo(message):
             parse_mode='Markdown'
         )
 
+def segment_image(image_bytes, chat_id, status_message_id):
+    """Remove the background via the API, falling back to the local engine"""
+    bot.edit_message_text(
+        "🎨 *Removing background...*",
+        chat_id,
+        status_message_id,
+        parse_mode='Markdown'
+    )
+    
+    # Remove background using API
+    if PROFILE_MEMORY:
+        transparent_image, peak = measure_peak_memory(remove_background_api, image_bytes)
+        logger.info(f"📈 Segmentation peak RSS: {format_peak(peak)}")
+    else:
+        transparent_image = remove_background_api(image_bytes)
+    
+    if not transparent_image:
+        # Fallback to local method
+        bot.edit_message_text(
+            "⚡ *Trying alternative method...*",
+            chat_id,
+            status_message_id,
+            parse_mode='Markdown'
+        )
+        transparent_image = remove_background_local(image_bytes)
+    
+    return transparent_image
+
+def render_pending(pending, color_choice, chat_id, status_message_id):
+    """Segment the pending photo on first use, then apply the background"""
+    with pending['lock']:
+        if pending['image'] is None:
+            if pending['source_bytes'] is None:
+                return None  # An earlier attempt on this photo already failed
+            pending['image'] = segment_image(pending['source_bytes'], chat_id, status_message_id)
+            # Either the decoded image supersedes the download or the photo failed
+            pending['source_bytes'] = None
+            if pending['image'] is None:
+                return None
+    return render_result(pending['image'], color_choice)
+
 def ask_for_color(chat_id, user_id):
     """Ask user to choose background color"""
     keyboard = types.InlineKeyboardMarkup(row_width=3)
@@ -447,47 +843,73 @@ def handle_color_choice(call):
         
         # Get transparent image for this user
         if user_id in user_pending_images:
-            transparent_bytes = user_pending_images[user_id]
-            
-            # Apply selected color
+            pending = user_pending_images[user_id]
             color_hex = COLOR_OPTIONS.get(color_name, "#FFFFFF")
-            final_image = apply_background_color(transparent_bytes, color_hex)
             
-            if final_image:
-                # Update user stats
-                if user_id in user_stats:
-                    user_stats[user_id]['images_processed'] += 1
-                
-                # Delete processing message
-                bot.delete_message(call.message.chat.id, processing_msg.message_id)
-                
-                # Prepare result caption
-                if color_name == "✨ Transparent":
-                    bg_info = "Transparent Background"
-                elif color_name == "🌈 Gradient":
-                    bg_info = "Rainbow Gradient Background"
-                else:
-                    bg_info = f"{color_name} Background"
-                
-                caption = f"""
+            # Reuse an earlier upload of the same result when we have one
+            result_key = ResultIndex.make_key(pending['source_hash'], color_hex)
+            cached_file_id = result_index.get(result_key)
+            
+            # Prepare result caption
+            if color_name == "✨ Transparent":
+                bg_info = "Transparent Background"
+            elif color_name == "🌈 Gradient":
+                bg_info = "Rainbow Gradient Background"
+            else:
+                bg_info = f"{color_name} Background"
+            
+            caption = f"""
 ✅ *Background Applied Successfully!*
 
 🎨 *Choice:* {bg_info}
 👤 *User:* {call.from_user.first_name}
-📸 *Total:* {user_stats.get(user_id, {}).get('images_processed', 1)} images
+📸 *Total:* {user_stats.get(user_id, {}).get('images_processed', 0) + 1} images
 💾 *Format:* PNG
 
 *Tip:* Save image and share! 📤
 """
+            
+            # Send by file_id when already uploaded: no segmentation, render or upload
+            sent = None
+            if cached_file_id:
+                try:
+                    sent = bot.send_document(
+                        chat_id=call.message.chat.id,
+                        document=cached_file_id,
+                        caption=caption,
+                        parse_mode='Markdown'
+                    )
+                    logger.info(f"♻️ Reused cached result for {color_name}")
+                except apihelper.ApiTelegramException as e:
+                    if not ResultIndex.is_stale_file_id_error(e):
+                        raise
+                    logger.warning(f"Cached file_id rejected, uploading again: {e}")
+                    result_index.discard(result_key)
+            
+            if sent is None:
+                # Apply selected color
+                final_image = render_pending(pending, color_hex, call.message.chat.id, processing_msg.message_id)
+                if final_image:
+                    sent = bot.send_document(
+                        chat_id=call.message.chat.id,
+                        document=final_image,
+                        visible_file_name=f"{color_name.replace(' ', '_')}_background.png",
+                        caption=caption,
+                        parse_mode='Markdown'
+                    )
+                    # Degraded cutouts made under load must not become the cached answer
+                    if sent.document and pending['image'].full_quality:
+                        result_index.put(result_key, sent.document.file_id)
+                    elif sent.document:
+                        logger.info(f"⏭️ Not caching degraded result ({pending['image'].source})")
+            
+            if sent:
+                # Update user stats
+                if user_id in user_stats:
+                    user_stats[user_id]['images_processed'] += 1
                 
-                # Send the final image
-                bot.send_document(
-                    chat_id=call.message.chat.id,
-                    document=final_image,
-                    visible_file_name=f"{color_name.replace(' ', '_')}_background.png",
-                    caption=caption,
-                    parse_mode='Markdown'
-                )
+                # Delete processing message
+                bot.delete_message(call.message.chat.id, processing_msg.message_id)
                 
                 # Send keyboard for next action
                 keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
@@ -505,12 +927,23 @@ def handle_color_choice(call):
                     reply_markup=keyboard
                 )
                 
-                # Clean up stored image
-                if user_id in user_pending_images:
+                # Clean up stored image, unless a newer photo has replaced it
+                if user_pending_images.get(user_id) is pending:
                     del user_pending_images[user_id]
                 
                 bot.answer_callback_query(call.id, f"Applied {color_name}!")
                 
+            elif pending['image'] is None:
+                # Background removal failed; the photo has to be sent again
+                if user_pending_images.get(user_id) is pending:
+                    del user_pending_images[user_id]
+                bot.edit_message_text(
+                    "❌ *Failed to remove background.*\n\n⚠️ Please try:\n• Different photo\n• Better lighting\n• Clearer subject",
+                    call.message.chat.id,
+                    processing_msg.message_id,
+                    parse_mode='Markdown'
+                )
+                
             else:
                 bot.edit_message_text(
                     "❌ *Failed to apply color.*\nPlease try again.",
@@ -698,15 +1131,44 @@ def health():
         "users": len(user_stats),
         "images_processed": sum(user['images_processed'] for user in user_stats.values()),
         "colors_available": len(COLOR_OPTIONS),
+        "cached_results": len(result_index),
+        "local_engine": local_engine.snapshot(),
         "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
     }
 
+@app.route('/webhook', methods=['POST'])
+def webhook():
+    """Receive updates pushed by Telegram when WEBHOOK_URL is set"""
+    if not WEBHOOK_URL:
+        abort(404)
+    
+    secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(secret, WEBHOOK_SECRET):
+        logger.warning("🚫 Webhook call with bad secret token rejected")
+        abort(403)
+    
+    update = types.Update.de_json(request.get_data(as_text=True))
+    bot.process_new_updates([update])
+    return "OK"
+
 # ==================== START BOT ====================
 def start_bot():
     """Start the Telegram bot"""
     logger.info("🤖 Starting Background Remover Bot Pro...")
     
+    # Only the process that handles updates needs local models, and only
+    # as a fallback when remove.bg is configured
+    if LOCAL_PRELOAD and not REMOVE_BG_API_KEY:
+        local_engine.start_preload()
+    
     try:
+        if WEBHOOK_URL:
+            # Telegram pushes updates to /webhook on the Flask app
+            bot.remove_webhook()
+            bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+            logger.info(f"🔗 Webhook set to {WEBHOOK_URL}")
+            return
+        
         # Remove any existing webhook
         bot.remove_webhook()
         time.sleep(2)